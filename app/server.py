@@ -1,26 +1,110 @@
 import os
-from flask import Flask, request, jsonify
+import math
+import time
+import random
+from flask import Flask, request, jsonify, after_this_request
 from flask_restful import Resource, Api, reqparse, abort, marshal, fields
 from flask_migrate import Migrate, MigrateCommand
 from flask_sqlalchemy import SQLAlchemy
 from flask_script import Manager
 import jsonpickle as jspk
+import json
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
 # Api imports
 # from worker import celery, app, api, db
 from datetime import datetime
+import uuid
 import celery.states as states
 # Database imports
-from utils.models import ClientsData, ServerData
-from utils.worker import app, api, celery, db
+from utils.models import ClientsData, ServerData, ModelVersion, MetricsData, MetricsSummary, create_version, prune_versions, rollback_version
+from utils.worker import app, api, celery, db, redis_store
+from utils.compression import encode_delta, delta_formats
 
 # Parameters
-SERVER_ID = int( os.environ.get('SERVER_ID') )
+SERVER_ID                = int( os.environ.get('SERVER_ID') )
+MAX_CONCURRENT_TRANSFERS = int( os.environ.get('MAX_CONCURRENT_TRANSFERS', 8) )
+TRANSFER_LEASE_SECONDS   = float( os.environ.get('TRANSFER_LEASE_SECONDS', 120) )
+POLL_INTERVAL_MIN        = float( os.environ.get('POLL_INTERVAL_MIN', 0.25) )
+POLL_INTERVAL_MAX        = float( os.environ.get('POLL_INTERVAL_MAX', 2.0) )
+ROUND_CHECK_INTERVAL     = float( os.environ.get('ROUND_CHECK_INTERVAL', 1.0) ) # beat period of tasks.check_clients_update
+KEEP_LAST_VERSIONS       = int( os.environ.get('KEEP_LAST_VERSIONS', 5) )
+KEEP_EVERY_VERSION       = int( os.environ.get('KEEP_EVERY_VERSION', 10) )
+DELTA_WINDOW             = KEEP_LAST_VERSIONS # versions back a client base can be to get a delta download
+DELTA_CACHE_SECONDS      = int( os.environ.get('DELTA_CACHE_SECONDS', 600) )
 
 # Initialize database
 task = celery.send_task('tasks.database_init', args=(), kwargs={})
 
 
 
+#### Backpressure ####
+
+
+
+# Redis sorted set of the weight downloads and uploads in flight, shared by all the api workers.
+# Every transfer holds a slot id scored by its lease expiry, so the slots of killed workers are freed after TRANSFER_LEASE_SECONDS
+transfers_key = f'server_{SERVER_ID}_transfers'
+
+def transfers_in_flight():
+	return redis_store.zcount(transfers_key, time.time(), '+inf')
+
+# Redis hash with the comunication round id and the ready / needed clients, published by tasks.check_clients_update every beat
+round_state_key = f'server_{SERVER_ID}_round_state'
+
+def round_state():
+	return {key.decode(): value.decode() for key, value in redis_store.hgetall(round_state_key).items()}
+
+def poll_interval(waiting_round, state=None):
+	# Next poll hint in seconds, jittered to spread the clients polls.
+	# Waiting for the round to close: up to POLL_INTERVAL_MAX while the round is far from closing or the transfers are busy,
+	# down to around half the round check period when enough clients are ready, so the close is noticed quickly.
+	# Ready to train: short, growing with the transfers in flight to spread the downloads at the round start
+	load = min(transfers_in_flight() / MAX_CONCURRENT_TRANSFERS, 1.0)
+	if waiting_round:
+		state    = state if state is not None else round_state()
+		progress = min(int(state.get('ready', 0)) / max(int(state.get('needed', 1)), 1), 1.0)
+		fastest  = min(ROUND_CHECK_INTERVAL / 2, POLL_INTERVAL_MAX)
+		interval = random.uniform(0.5, 1.5) * (fastest + (POLL_INTERVAL_MAX - fastest) * max(1.0 - progress, load))
+	else:
+		interval = random.uniform(0.5, 1.0) * POLL_INTERVAL_MAX * load
+	return round(max(POLL_INTERVAL_MIN, interval), 2)
+
+def poll_headers(waiting_round, state=None):
+	return {'X-Poll-Interval': str(poll_interval(waiting_round, state))}
+
+def wants_weights(keys):
+	# The weights are returned when no keys are specified or when explicitly requested
+	return not keys or 'weights' in keys
+
+def acquire_transfer_slot():
+	# Admission control of the weight transfers: lease a slot, None when the concurrency limit is reached
+	now      = time.time()
+	slot_id  = uuid.uuid4().hex
+	pipeline = redis_store.pipeline()
+	pipeline.zremrangebyscore(transfers_key, '-inf', now) # expired leases
+	pipeline.zadd(transfers_key, {slot_id: now + TRANSFER_LEASE_SECONDS})
+	pipeline.zcard(transfers_key)
+	if pipeline.execute()[-1] > MAX_CONCURRENT_TRANSFERS:
+		redis_store.zrem(transfers_key, slot_id)
+		return None
+
+	# The slot is released once the response body has been sent, not when the handler returns
+	@after_this_request
+	def release_transfer_slot(response):
+		response.call_on_close(lambda: redis_store.zrem(transfers_key, slot_id))
+		return response
+
+	return slot_id
+
+def too_many_transfers():
+	# 429 with a jittered backoff suggestion that grows with the transfers in flight
+	load        = max(transfers_in_flight() / MAX_CONCURRENT_TRANSFERS, 1.0)
+	retry_after = round(random.uniform(1.0, 2.0) * max(POLL_INTERVAL_MIN, 0.5) * load, 2)
+	return {'message': 'Too many weight transfers in progress, retry later', 'retry_after': retry_after}, 429, {'Retry-After': str(math.ceil(retry_after))}
+
+
+
 #### Client ####
 
 
@@ -52,16 +136,28 @@ client_resource_fields = {
 class Clients(Resource):
 	def get(self):
 		data      = clients_get_args.parse_args()
+		keys      = data['return_keys']
+		if not wants_weights(keys):
+			return self.get_client(data)
+		if not acquire_transfer_slot():
+			return too_many_transfers()
+		return self.get_client(data)
+
+	def get_client(self, data):
 		client_id = data['client_id']
 		keys      = data['return_keys']
 		result    = ClientsData.query.filter_by(client_id=client_id).first()
 		if not result: # if client not found (result == None) return error
 			abort(404, message=f'Could not find client with id {client_id}')
+		# Client already uploaded in the current round of the server: wait for the round to close.
+		# The round id comes from the published round state, no server query on every poll
+		state       = round_state()
+		headers     = poll_headers(result.state == 'updated' and result.com_round_id == state.get('com_round_id'), state)
 		output_dict = marshal(result, client_resource_fields)
 		if keys: # if keys are specified return only that elements of the client information 
-			return {**{'client_id':client_id}, **dict(zip(keys, map(output_dict.get, keys)))} # join the two dictionaries
+			return {**{'client_id':client_id}, **dict(zip(keys, map(output_dict.get, keys)))}, 200, headers # join the two dictionaries
 		else: 
-			return output_dict
+			return output_dict, 200, headers
 
 	def post(self):
 		data      = clients_post_args.parse_args()
@@ -76,6 +172,11 @@ class Clients(Resource):
 		return {'message':f'Creation of client {client_id} weights successful', 'client_id':client_id}, 201
 		
 	def put(self):
+		if not acquire_transfer_slot():
+			return too_many_transfers()
+		return self.put_client()
+
+	def put_client(self):
 		data      = clients_post_args.parse_args() # same args as post
 		client_id = data['client_id']
 		result    = ClientsData.query.filter_by(client_id=client_id).first()
@@ -89,7 +190,7 @@ class Clients(Resource):
 		result.last_modified = datetime.utcnow()
 		db.session.commit()
 				
-		return {'message':f'Update of client {client_id} weights successful', 'client_id':client_id}, 202
+		return {'message':f'Update of client {client_id} weights successful', 'client_id':client_id}, 202, poll_headers(True)
 
 	def delete(self):
 		data      = clients_get_args.parse_args()
@@ -109,6 +210,66 @@ class Clients(Resource):
 
 
 
+#### Clients fleet ####
+
+
+
+# Request parsers
+
+clients_list_args = reqparse.RequestParser()
+clients_list_args.add_argument('after_id'       , type=int, help='return the clients after this client_id, can be None' , required=False)
+clients_list_args.add_argument('limit'          , type=int, help='page size, can be None'                               , required=False, default=100)
+clients_list_args.add_argument('state'          , type=str, help='filter by client state'                               , required=False, action='append')
+clients_list_args.add_argument('com_round_id'   , type=str, help='filter by comunication round'                         , required=False)
+clients_list_args.add_argument('modified_after' , type=str, help='filter by last_modified >= value (YYYY-MM-DD HH:MM:SS)', required=False)
+clients_list_args.add_argument('modified_before', type=str, help='filter by last_modified < value (YYYY-MM-DD HH:MM:SS)' , required=False)
+
+clients_summary_args = reqparse.RequestParser()
+clients_summary_args.add_argument('server_id', type=int, help='server_id is required', required=True)
+
+# Resource fields for marshal serializer, the weights are never loaded in the listings
+clients_list_resource_fields = {key: field for key, field in client_resource_fields.items() if key != 'weights'}
+clients_list_max_limit       = 1000
+
+# Resource: flask api
+class Clients_List(Resource):
+	def get(self):
+		data  = clients_list_args.parse_args()
+		limit = min(max(data['limit'], 1), clients_list_max_limit)
+		# Keyset pagination over the client_id primary key
+		query = ClientsData.query.with_entities(*[getattr(ClientsData, key) for key in clients_list_resource_fields])
+		if data['after_id'] is not None:
+			query = query.filter(ClientsData.client_id > data['after_id'])
+		if data['state']:
+			query = query.filter(ClientsData.state.in_(data['state']))
+		if data['com_round_id'] is not None:
+			query = query.filter(ClientsData.com_round_id == data['com_round_id'])
+		if data['modified_after']:
+			query = query.filter(ClientsData.last_modified >= data['modified_after'])
+		if data['modified_before']:
+			query = query.filter(ClientsData.last_modified < data['modified_before'])
+		clients  = query.order_by(ClientsData.client_id).limit(limit).all()
+		after_id = clients[-1].client_id if len(clients) == limit else None # None when there are no more pages
+
+		return {'clients': marshal(clients, clients_list_resource_fields), 'after_id': after_id}
+
+class Clients_Summary(Resource):
+	def get(self):
+		data          = clients_summary_args.parse_args()
+		server_id     = data['server_id']
+		server_com_id = ServerData.query.with_entities(ServerData.com_round_id).filter_by(server_id=server_id).scalar()
+		if server_com_id is None: # if server not found (result == None) return error
+			abort(404, message=f'Could not find server with id {server_id}')
+		# Per state counts of the clients in the current comunication round of the server, served by ix_clients_data_round_state
+		counts = db.session.query(ClientsData.state, func.count(ClientsData.client_id)).filter(ClientsData.com_round_id == server_com_id).group_by(ClientsData.state).all()
+		total  = db.session.query(func.count(ClientsData.client_id)).scalar()
+		current_round = {state: count for state, count in counts}
+		output_dict   = {'server_id': server_id, 'com_round_id': server_com_id, 'total': total, 'current_round': current_round, 'other_rounds': total - sum(current_round.values())}
+
+		return output_dict
+
+
+
 #### Server ####
 
 
@@ -116,8 +277,11 @@ class Clients(Resource):
 # Request parsers
 
 server_get_args = reqparse.RequestParser()
-server_get_args.add_argument('server_id'  , type=int, help='server_id is required'                            , required=True)
-server_get_args.add_argument('return_keys', type=str, help='return only the specified keys of the server data', action='append')
+server_get_args.add_argument('server_id'    , type=int, help='server_id is required'                                                     , required=True)
+server_get_args.add_argument('return_keys'  , type=str, help='return only the specified keys of the server data'                         , action='append')
+server_get_args.add_argument('version'      , type=int, help='model version of the weights, can be None for the served one'              , required=False)
+server_get_args.add_argument('base_version_key', type=str, help='version_key of the last synced model, can be None for a full download', required=False)
+server_get_args.add_argument('delta_format' , type=str, help='delta encoding of the weights: quantized or sparse'                      , required=False, default='quantized', choices=delta_formats)
 
 server_post_args = reqparse.RequestParser()
 server_post_args.add_argument('server_id'   , type=int, help='server_id is required'                               , required=True)
@@ -128,26 +292,80 @@ server_post_args.add_argument('com_round_id', type=str, help='com_round_id is re
 
 # Resource fields for marshal serializer 
 server_resource_fields = {
-	'server_id'   : fields.Integer,
-	'state'       : fields.String,
-	'weights'     : fields.String,
-	'com_round_id': fields.String
+	'server_id'    : fields.Integer,
+	'state'        : fields.String,
+	'model_version': fields.Integer,
+	'com_round_id' : fields.String
 }
 
+def server_model(server_id, version, *columns):
+	# Columns of a model version of the server, the weights are only loaded when requested
+	result = ModelVersion.query.with_entities(*columns).filter_by(server_id=server_id).filter_by(version=version).first()
+	if not result: # if version not found (result == None) return error
+		abort(404, message=f'Could not find model version {version} of server {server_id}')
+	return result
+
+def base_version(server_id, base_version_key, version):
+	# Version last synced by a client, None if it is not kept or too old to serve a delta from it
+	result = ModelVersion.query.with_entities(ModelVersion.version, ModelVersion.version_key).filter_by(server_id=server_id).filter_by(version_key=base_version_key).first()
+	if not result or not version - DELTA_WINDOW <= result.version <= version:
+		return None
+	return result
+
+def server_delta(server_id, base, target, delta_format):
+	# Delta between two model versions, None when it is not smaller than the full weights (e.g. sparse after a dense update).
+	# Cached since the versions are immutable, keyed by the unique version keys as the version numbers are reused when a server or the database is recreated
+	delta_key = f'server_{server_id}_delta_{base.version_key}_{target.version_key}_{delta_format}'
+	delta     = redis_store.get(delta_key)
+	if delta is not None:
+		return delta.decode() or None # empty string: full download is smaller
+	weights         = server_model(server_id, target.version, ModelVersion.weights).weights
+	base_state_dict = jspk.decode(server_model(server_id, base.version, ModelVersion.weights).weights)
+	delta           = encode_delta(jspk.decode(weights), base_state_dict, delta_format)
+	if len(delta) >= len(weights):
+		delta = ''
+	redis_store.set(delta_key, delta, ex=DELTA_CACHE_SECONDS)
+	return delta or None
+
 # Resource: flask api
 class Server(Resource):
 	def get(self):
 		data      = server_get_args.parse_args()
+		keys      = data['return_keys']
+		if not wants_weights(keys):
+			return self.get_server(data)
+		if not acquire_transfer_slot():
+			return too_many_transfers()
+		return self.get_server(data)
+
+	def get_server(self, data):
 		server_id = data['server_id']
 		keys      = data['return_keys']
 		result    = ServerData.query.filter_by(server_id=server_id).first()
 		if not result: # if server not found (result == None) return error
 			abort(404, message=f'Could not find server with id {server_id}')
+		# Server not waiting for clients updates: wait for the round to close
+		headers     = poll_headers(result.state != 'waiting')
 		output_dict = marshal(result, server_resource_fields)
+		if wants_weights(keys): # weights read through the server pointer, or an older version if requested
+			version = data['version'] or result.model_version
+			target  = server_model(server_id, version, ModelVersion.version, ModelVersion.version_key, ModelVersion.com_round_id)
+			base    = base_version(server_id, data['base_version_key'], version) if data['base_version_key'] else None
+			delta   = server_delta(server_id, base, target, data['delta_format']) if base is not None else None
+			output_dict['model_version']  = version
+			output_dict['version_key']    = target.version_key
+			output_dict['model_round_id'] = target.com_round_id
+			if delta is not None: # delta against the model the client already holds, instead of the weights
+				output_dict['base_version'] = base.version
+				output_dict['delta']        = delta
+				keys = keys and [key for key in keys if key != 'weights'] + ['model_version', 'version_key', 'model_round_id', 'base_version', 'delta']
+			else: # full download when the client has no base, it is too old or the delta would not be smaller
+				output_dict['weights'] = server_model(server_id, version, ModelVersion.weights).weights
+				keys = keys and keys + ['model_version', 'version_key', 'model_round_id']
 		if keys: # if keys are specified return only that elements of the server information 
-			return {**{'server_id':server_id}, **dict(zip(keys, map(output_dict.get, keys)))} # join the two dictionaries
+			return {**{'server_id':server_id}, **dict(zip(keys, map(output_dict.get, keys)))}, 200, headers # join the two dictionaries
 		else: 
-			return output_dict
+			return output_dict, 200, headers
 
 	def post(self):
 		data      = server_post_args.parse_args()
@@ -155,7 +373,8 @@ class Server(Resource):
 		result    = ServerData.query.filter_by(server_id=server_id).first()
 		if result: # if server already exists (result != None) return error
 			abort(409, message=f'Server id {server_id} is taken...')
-		server = ServerData(server_id=data['server_id'], state=data['state'], weights=data['weights'], com_round_id=data['com_round_id'], last_modified = datetime.utcnow())
+		model_version = create_version(server_id, data['com_round_id'], data['weights'])
+		server = ServerData(server_id=data['server_id'], state=data['state'], model_version=model_version.version, com_round_id=data['com_round_id'], last_modified = datetime.utcnow())
 		db.session.add(server)
 		db.session.commit()
 		
@@ -164,14 +383,17 @@ class Server(Resource):
 	def put(self):
 		data      = server_post_args.parse_args() # same args as post
 		server_id = data['server_id']
-		result    = ServerData.query.filter_by(server_id=server_id).first()
+		result    = ServerData.query.filter_by(server_id=server_id).with_for_update().first()
 		if not result: # if server not found (result == None) return error
 			abort(404, message=f'Could not find server with id {server_id}, cannot update')
+		# New weights are stored as a new model version
+		model_version        = create_version(server_id, data['com_round_id'], data['weights'])
 		result.server_id     = data['server_id']
-		result.weights       = data['weights']
+		result.model_version = model_version.version
 		result.state         = data['state']
 		result.com_round_id  = data['com_round_id']
 		result.last_modified = datetime.utcnow()
+		prune_versions(server_id, KEEP_LAST_VERSIONS, KEEP_EVERY_VERSION, pinned=model_version.version)
 		db.session.commit()
 
 		return {'message':f'Update of server {server_id} weights successful', 'server_id':server_id}, 202
@@ -186,7 +408,10 @@ class Server(Resource):
 		output_dict = {}
 		if keys: # if keys are specified return only that elements of the server information 
 			output_dict = marshal(result, server_resource_fields)
+			if wants_weights(keys):
+				output_dict['weights'] = server_model(server_id, result.model_version, ModelVersion.weights).weights
 			output_dict = {**{'server_id':server_id}, **dict(zip(keys, map(output_dict.get, keys)))} # join the two dictionaries
+		ModelVersion.query.filter_by(server_id=server_id).delete(synchronize_session=False)
 		db.session.delete(result)
 		db.session.commit()
 
@@ -194,29 +419,140 @@ class Server(Resource):
 
 
 
+#### Rollback ####
+
+
+
+# Request parser
+rollback_parser = reqparse.RequestParser()
+rollback_parser.add_argument('server_id', type=int, help='server_id is required'                     , required=True)
+rollback_parser.add_argument('version'  , type=int, help='model version to serve again is required', required=True)
+
+# Resource: flask api
+class Rollback(Resource):
+	def post(self):
+		data      = rollback_parser.parse_args()
+		server_id = data['server_id']
+		version   = data['version']
+		result    = ServerData.query.filter_by(server_id=server_id).with_for_update().first()
+		if not result: # if server not found (result == None) return error
+			abort(404, message=f'Could not find server with id {server_id}')
+		if not ModelVersion.query.with_entities(ModelVersion.version).filter_by(server_id=server_id).filter_by(version=version).first():
+			abort(404, message=f'Could not find model version {version} of server {server_id}')
+		# Pointer swap to the old version and new comunication round, the clients of the dropped round are reset in the same transaction
+		com_round_id = uuid.uuid1()
+		n_clients    = rollback_version(result, version, com_round_id)
+		db.session.commit()
+
+		return {'message': f'Rollback of server {server_id} to model version {version} successful, {n_clients} clients of the dropped round reset', 'server_id': server_id, 'com_round_id': f'{com_round_id}'}
+
+
+
+#### Metrics ####
+
+
+
+# Request parsers
+
+metrics_get_args = reqparse.RequestParser()
+metrics_get_args.add_argument('server_id' , type=int, help='server_id is required'                     , required=True)
+metrics_get_args.add_argument('from_round', type=int, help='first round of the summaries, can be None'  , required=False)
+metrics_get_args.add_argument('to_round'  , type=int, help='last round of the summaries, can be None'   , required=False)
+metrics_get_args.add_argument('metric'    , type=str, help='return only the specified metrics summaries', required=False, action='append')
+
+metrics_post_args = reqparse.RequestParser()
+metrics_post_args.add_argument('server_id', type=int, help='server_id is required'                                                      , required=True)
+metrics_post_args.add_argument('client_id', type=int, help='client_id is required'                                                      , required=True)
+metrics_post_args.add_argument('metrics'  , type=str, help='json list of per round metrics, e.g. [{"round": 1, "accuracy": 0.9}], is required', required=True)
+
+# Resource fields for marshal serializer 
+metrics_summary_resource_fields = {
+	'com_round'   : fields.Integer,
+	'metric'      : fields.String,
+	'participants': fields.Integer,
+	'count'       : fields.Integer,
+	'mean'        : fields.Float,
+	'min'         : fields.Float,
+	'p10'         : fields.Float,
+	'p50'         : fields.Float,
+	'p90'         : fields.Float,
+	'max'         : fields.Float,
+	'stale'       : fields.Boolean, # metrics ingested since the last refresh
+}
+
+# Resource: flask api
+class Metrics(Resource):
+	def get(self):
+		data      = metrics_get_args.parse_args()
+		server_id = data['server_id']
+		query     = MetricsSummary.query.filter_by(server_id=server_id)
+		if data['from_round'] is not None:
+			query = query.filter(MetricsSummary.com_round >= data['from_round'])
+		if data['to_round'] is not None:
+			query = query.filter(MetricsSummary.com_round <= data['to_round'])
+		if data['metric']:
+			query = query.filter(MetricsSummary.metric.in_(data['metric']))
+		# Read only: the stale summaries are refreshed by tasks.refresh_metrics_summaries
+		summaries = query.order_by(MetricsSummary.com_round, MetricsSummary.metric).all()
+
+		return {'server_id': server_id, 'summaries': marshal(summaries, metrics_summary_resource_fields)}
+
+	def post(self):
+		data      = metrics_post_args.parse_args()
+		server_id = data['server_id']
+		client_id = data['client_id']
+		try:
+			records = json.loads(data['metrics'])
+			rows    = [{'server_id': server_id, 'client_id': client_id, 'com_round': int(record['round']), 'metric': metric, 'value': float(value), 'last_modified': datetime.utcnow()}
+			           for record in records for metric, value in record.items() if metric != 'round' and value is not None]
+		except (ValueError, TypeError, KeyError):
+			abort(400, message='metrics must be a json list of objects with a round and numeric metric values')
+		if not rows:
+			return {'message': 'No metrics to store', 'client_id': client_id}, 200
+		# Append the raw rows and flag the summaries of the touched rounds as stale, in one transaction
+		db.session.bulk_insert_mappings(MetricsData, rows)
+		summary_keys = [{'server_id': server_id, 'com_round': com_round, 'metric': metric, 'stale': True, 'ingested': 1} for com_round, metric in {(row['com_round'], row['metric']) for row in rows}]
+		db.session.execute(insert(MetricsSummary).values(summary_keys).on_conflict_do_update(index_elements=['server_id', 'com_round', 'metric'], set_={'stale': True, 'ingested': MetricsSummary.ingested + 1}))
+		db.session.commit()
+
+		return {'message': f'Storage of {len(rows)} metrics of client {client_id} successful', 'client_id': client_id}, 201
+
+
+
 #### Clear ####
 
 
 
+# Tables that can be truncated between runs, the server table is reset instead.
+# The metrics summaries are derived from the raw metrics, the two tables are always truncated together
+truncate_tables = {'clients_data'   : ['clients_data'],
+                   'metrics_data'   : ['metrics_data', 'metrics_summary'],
+                   'metrics_summary': ['metrics_data', 'metrics_summary']}
+
+def truncate(table_names):
+	# Empty the tables and restart their autoincrement values in one statement, to run easily another simulation
+	if not set(table_names) <= set(truncate_tables):
+		abort(400, message=f'Only {list(truncate_tables)} suported as table_name.')
+	table_names = sorted({table for table_name in table_names for table in truncate_tables[table_name]})
+	if table_names:
+		db.session.execute(text(f'TRUNCATE {", ".join(table_names)} RESTART IDENTITY'))
+	return table_names
+
 # Request parser
 clear_parser = reqparse.RequestParser()
-clear_parser.add_argument('table_name', type=str, help='table_name is required', required=True)
-clear_parser.add_argument('column'    , type=str, help='column is required'    , required=True)
+clear_parser.add_argument('table_name', type=str, help='table_name is required'                          , required=True)
+clear_parser.add_argument('column'    , type=str, help='column is not needed, identities are always reset', required=False)
 
 # Resource: flask api
 class Clear_Table(Resource):
 	def post(self):
 		data       = clear_parser.parse_args()
-		table_name = data['table_name']
-		column     = data['column']
-		# Delete all entries of the clients database
-		db.engine.execute(f'DELETE FROM {table_name}')
-		# Reset autoincrement value of database to zero, to run easily another simulation
-		db.engine.execute(f'ALTER SEQUENCE {table_name}_{column}_seq RESTART WITH 1')
+		table_name  = data['table_name']
+		table_names = truncate([table_name])
 		# Commit changes to database
 		db.session.commit()
 
-		return {'message': f'Table {table_name} cleared successfully.'}
+		return {'message': f'Tables {table_names} cleared successfully.'}
 
 
 
@@ -228,7 +564,12 @@ class Clear_Table(Resource):
 # Request parser
 reset_parser = reqparse.RequestParser()
 reset_parser.add_argument('table_name', type=str, help='table_name is required'                     , required=True)
-reset_parser.add_argument('row_id'    , type=str, help='row_id is required (client_id or server_id)', required=True)
+reset_parser.add_argument('row_id'    , type=str, help='row_id is required (client_id or server_id)', required=True, action='append')
+
+reset_run_parser = reqparse.RequestParser()
+reset_run_parser.add_argument('server_id', type=int, help='server_id is required'                                 , required=True)
+reset_run_parser.add_argument('truncate' , type=str, help='tables to empty, clients_data if None and no client_id', required=False, action='append')
+reset_run_parser.add_argument('client_id', type=int, help='clients to reset to untrained weights, can be None'       , required=False, action='append')
 
 
 # Resource: flask api
@@ -237,18 +578,36 @@ class Reset(Resource):
 		data       = reset_parser.parse_args()
 		table_name = data['table_name']
 		if table_name == 'server_data':
-			server_id = data['row_id']
+			server_id = data['row_id'][0]
 			task = celery.send_task('tasks.reset_server_weights', args=(), kwargs={'server_id': server_id})
 
 			return {'message': 'Reseting server weights', 'server_id': server_id, 'task_id': task.id}
 		elif table_name == 'clients_data':
-			client_id = data['row_id']
-			task = celery.send_task('tasks.reset_client_weights', args=(), kwargs={'client_id': client_id})
+			# All the clients are reset by a single task with one bulk update
+			client_ids = data['row_id']
+			task = celery.send_task('tasks.reset_clients_weights', args=(), kwargs={'client_ids': client_ids})
 
-			return {'message': 'Reseting client weights', 'client_id': client_id, 'task_id': task.id}
+			return {'message': 'Reseting clients weights', 'client_ids': client_ids, 'task_id': task.id}
 		else:
 			return {'message': 'Only server_data and clients_data suported as table_name.'}
 
+class Reset_Run(Resource):
+	def post(self):
+		# Reset of a whole run: truncate the run tables and reset the server and the kept clients
+		data        = reset_run_parser.parse_args()
+		server_id   = data['server_id']
+		client_ids  = data['client_id'] or []
+		# The clients table is emptied by default, unless some clients are kept to be reset
+		table_names = data['truncate'] if data['truncate'] is not None else ([] if client_ids else ['clients_data'])
+		if client_ids and 'clients_data' in table_names:
+			abort(400, message='client_id cannot be reset when clients_data is truncated.')
+		table_names = truncate(table_names)
+		db.session.commit()
+		task = celery.send_task('tasks.reset_run', args=(), kwargs={'server_id': server_id, 'client_ids': client_ids})
+		message = f'Tables {table_names} cleared successfully, reseting server weights' + (f' and {len(client_ids)} clients weights' if client_ids else '')
+
+		return {'message': message, 'server_id': server_id, 'client_ids': client_ids, 'task_id': task.id}
+
 
 
 
@@ -262,10 +621,15 @@ def index():
 	return {'message': 'FFL: Simple API with Restful'}
 
 # Define and add resources
-api.add_resource(Clients,     '/api/v1.0/clients/')
-api.add_resource(Server,      '/api/v1.0/server/')
-api.add_resource(Clear_Table, '/api/v1.0/clear_table/')
-api.add_resource(Reset,       '/api/v1.0/reset/')
+api.add_resource(Clients,         '/api/v1.0/clients/')
+api.add_resource(Clients_List,    '/api/v1.0/clients/list/')
+api.add_resource(Clients_Summary, '/api/v1.0/clients/summary/')
+api.add_resource(Server,          '/api/v1.0/server/')
+api.add_resource(Clear_Table,     '/api/v1.0/clear_table/')
+api.add_resource(Reset,           '/api/v1.0/reset/')
+api.add_resource(Reset_Run,       '/api/v1.0/reset_run/')
+api.add_resource(Rollback,        '/api/v1.0/rollback/')
+api.add_resource(Metrics,         '/api/v1.0/metrics/')
 
 # Run app
 if __name__ == '__main__':
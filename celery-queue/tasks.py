@@ -1,6 +1,7 @@
 # Imports
 import os
 import time
+from functools import lru_cache
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 import jsonpickle as jspk
@@ -10,15 +11,29 @@ from datetime import timedelta, datetime
 # Federated imports
 import forcast_federated_learning as ffl
 import uuid
+from sqlalchemy import func, and_, bindparam
 # Database imports
-from utils.models import ClientsData, ServerData
-from utils.worker import app, celery, db
+from utils.models import ClientsData, ServerData, ModelVersion, MetricsData, MetricsSummary, create_version, close_round, upgrade_schema
+from utils.worker import app, celery, db, redis_store
+# Aggregation imports
+from utils.aggregation import aggregate, aggregation_rules
 
 # Parameters
 SERVER_ID                          = int( os.environ.get('SERVER_ID') )
 seed                               = int( os.environ.get('SEED') )
 k_ready_clients_needed             = 5
 percentage_of_ready_clients_needed = 100
+# Aggregation rule of the job: mean, median, trimmed_mean, clipped_mean or krum
+aggregation_rule                   = os.environ.get('AGGREGATION_RULE', 'mean')
+aggregation_params                 = {'trim_ratio': float( os.environ.get('TRIM_RATIO', 0.1) ),
+                                      'clip_norm' : float( os.environ.get('CLIP_NORM', 1.0) ),
+                                      'krum_f'    : int( os.environ.get('KRUM_F', 1) ),
+                                      'krum_m'    : int( os.environ.get('KRUM_M', 1) )}
+if aggregation_rule not in aggregation_rules:
+	raise ValueError(f'AGGREGATION_RULE {aggregation_rule} not supported, use one of {list(aggregation_rules)}')
+# Model versions retention: keep the last versions and every n-th version
+keep_last_versions                 = int( os.environ.get('KEEP_LAST_VERSIONS', 5) )
+keep_every_version                 = int( os.environ.get('KEEP_EVERY_VERSION', 10) )
 
 
 
@@ -30,6 +45,10 @@ celery.conf.beat_schedule = {
 	'Check clients updates': {
 		'task': 'tasks.check_clients_update',
 		'schedule': timedelta(milliseconds=1_000)
+		},
+	'Refresh metrics summaries': {
+		'task': 'tasks.refresh_metrics_summaries',
+		'schedule': timedelta(milliseconds=5_000)
 		}
 	}
 celery.conf.timezone = 'UTC'
@@ -45,12 +64,24 @@ num_features, num_classes = 4, 3
 model           = ffl.models.NN(input_dim=num_features, output_dim=num_classes, init_seed=seed) # pytorch model
 fed_model       = ffl.FederatedModel(model, model_type='nn')
 
+@lru_cache(maxsize=None)
+def initial_weights(init_seed):
+	# Encoded untrained weights, computed once per seed and shared by all the resets
+	return jspk.encode(ffl.models.NN(input_dim=num_features, output_dim=num_classes, init_seed=init_seed).state_dict())
+
 
 
 #### Periodic tasks ####
 
 
 
+# Round progress read by the api for the clients poll hints
+round_state_key = f'server_{SERVER_ID}_round_state'
+
+def publish_round_state(com_round_id, k_ready_clients):
+	redis_store.hset(round_state_key, mapping={'com_round_id': f'{com_round_id}', 'ready': k_ready_clients, 'needed': k_ready_clients_needed})
+	redis_store.expire(round_state_key, 60)
+
 @celery.task(name ='tasks.check_clients_update')
 def check_clients_update():
 	# Check if there's server data in the database
@@ -72,15 +103,14 @@ def check_clients_update():
 	# Check client database
 	
 	# Total number of clients in the database
-	clients_all     = ClientsData.query.all()
-	n_clients       = len( clients_all )
+	n_clients       = ClientsData.query.count()
 	# Check existance of at least one client
 	if n_clients == 0:
 		return {'message': f'Could not find clients in the database'}
 	
 	# Ready clients: Ones that have updated their models to the database and are in the same comunication round as the server
-	clients_ready   = ClientsData.query.filter_by(state='updated').filter_by(com_round_id=server_com_id).all()
-	k_ready_clients = len( clients_ready )
+	k_ready_clients = ClientsData.query.filter_by(state='updated').filter_by(com_round_id=server_com_id).count()
+	publish_round_state(server_com_id, k_ready_clients)
 
 	percentage_of_ready_clients = 100 * k_ready_clients / n_clients
 	if k_ready_clients < k_ready_clients_needed: # percentage_of_ready_clients < percentage_of_ready_clients_needed:
@@ -90,41 +120,108 @@ def check_clients_update():
 	## Else: Everything ok ##
 	
 
+	# Lock the server row for the whole round close, overlapping beat ticks skip the locked row instead of aggregating twice
+	server_data = ServerData.query.filter_by(server_id=SERVER_ID).with_for_update(skip_locked=True).populate_existing().first()
+	if not server_data or server_data.state == 'updated' or server_data.com_round_id != server_com_id: # round already closed by another tick
+		db.session.rollback()
+		return {'message': f'Server {SERVER_ID} round is being updated by another task'}
+	# Ready clients read inside the transaction
+	clients_ready   = ClientsData.query.filter_by(state='updated').filter_by(com_round_id=server_com_id).populate_existing().all()
+	k_ready_clients = len( clients_ready )
+	if k_ready_clients < k_ready_clients_needed:
+		db.session.rollback()
+		return {'message': f'{k_ready_clients} / {n_clients} ready clients not enough'}
+
 	messages = []
-	messages.append(f'{k_ready_clients} / {n_clients} ready clients, starting federated update')
+	messages.append(f'{k_ready_clients} / {n_clients} ready clients, starting federated update with {aggregation_rule} aggregation')
 	new_server_com_id = uuid.uuid1()
 
 	# Get the client weights and local data length for the federated aggregation
+	client_ids     = []
 	client_weights = []
 	client_lens    = []
 	# Iterate over clients database rows
 	for client_data in clients_ready:
+		client_ids.append( client_data.client_id )
 		client_weights.append( jspk.decode(client_data.weights) )
 		client_lens.append( client_data.data_len )
 		
 	## Update fedearted model ##
 
-	fed_model.server_agregate(client_weights, client_lens)
-	weights = jspk.encode(fed_model.state_dict())
-
-	# Update server database
-	server_data.weights       = weights
-	server_data.state         = 'waiting'
-	server_data.com_round_id  = new_server_com_id # new comunication round
-	server_data.last_modified = datetime.utcnow()
+	# Only the clipped mean needs the served model, as the reference of the client updates
+	server_weights = None
+	if aggregation_rule == 'clipped_mean':
+		server_model = ModelVersion.query.get((SERVER_ID, server_data.model_version)) if server_data.model_version is not None else None
+		if server_model is None:
+			raise ValueError(f'Model version {server_data.model_version} of server {SERVER_ID} not found, clipped_mean needs the served model as reference')
+		server_weights = jspk.decode(server_model.weights)
+	state_dict     = aggregate(client_weights, client_lens, rule=aggregation_rule, reference=server_weights, **aggregation_params)
+	fed_model.load_state_dict(state_dict)
+	weights        = jspk.encode(fed_model.state_dict())
+
+	# Store the new model version, swap the server pointer to it, reset the participants and prune the old versions
+	model_version = close_round(server_data, client_ids, weights, new_server_com_id, keep_last_versions, keep_every_version)
+
+	# Single commit for the server and the clients, releases the server row lock
 	db.session.commit()
-	messages.append(f'Update of server with id {SERVER_ID}, successful')
-
-	## Update the clients ##
-	for client_data in clients_ready:
-		client_data.state         = 'iddle'
-		client_data.last_modified = datetime.utcnow()
-		db.session.commit()
+	publish_round_state(new_server_com_id, 0)
+	messages.append(f'Update of server with id {SERVER_ID} to model version {model_version.version}, successful')
+	messages.append(f'Update of {len(client_ids)} clients, successful')
 
 	return {'messages': messages, 'new communication round id': f'{new_server_com_id}'}
 
 
 
+def summarize_rounds(server_id, stale_summaries):
+	# Recompute the stale summaries with one grouped query over their rounds partitions of the raw metrics
+	ingested  = {(com_round, metric): count for com_round, metric, count in stale_summaries}
+	rounds    = list({com_round for com_round, _ in ingested})
+	summaries = db.session.query(
+		MetricsData.com_round,
+		MetricsData.metric,
+		func.count(func.distinct(MetricsData.client_id)),
+		func.count(MetricsData.value),
+		func.avg(MetricsData.value),
+		func.min(MetricsData.value),
+		func.percentile_cont(0.1).within_group(MetricsData.value),
+		func.percentile_cont(0.5).within_group(MetricsData.value),
+		func.percentile_cont(0.9).within_group(MetricsData.value),
+		func.max(MetricsData.value),
+	).filter(MetricsData.server_id == server_id).filter(MetricsData.com_round.in_(rounds)).group_by(MetricsData.com_round, MetricsData.metric).all()
+	keys = ['participants', 'count', 'mean', 'min', 'p10', 'p50', 'p90', 'max']
+	rows = [{**dict(zip(keys, values)), 'stale': False, 'last_modified': datetime.utcnow(), 'b_server_id': server_id, 'b_com_round': com_round, 'b_metric': metric, 'b_ingested': ingested[(com_round, metric)]}
+	        for com_round, metric, *values in summaries if (com_round, metric) in ingested]
+	if not rows:
+		return
+	# Conditional on the ingestions counter: a summary with rows ingested during its computation stays stale
+	table     = MetricsSummary.__table__
+	statement = table.update().where(and_(
+		table.c.server_id == bindparam('b_server_id'),
+		table.c.com_round == bindparam('b_com_round'),
+		table.c.metric    == bindparam('b_metric'),
+		table.c.ingested  == bindparam('b_ingested'),
+	))
+	db.session.execute(statement, rows)
+
+
+
+@celery.task(name='tasks.refresh_metrics_summaries')
+def refresh_metrics_summaries():
+	# Recompute the summaries flagged stale by the metrics ingestion, the api only reads the summaries table
+	if 'metrics_summary' not in db.engine.table_names():
+		return {'message': 'No metrics summary table in the database'}
+	stale_summaries = MetricsSummary.query.filter_by(stale=True).with_entities(MetricsSummary.server_id, MetricsSummary.com_round, MetricsSummary.metric, MetricsSummary.ingested).all()
+	servers = {}
+	for server_id, com_round, metric, ingested in stale_summaries:
+		servers.setdefault(server_id, []).append((com_round, metric, ingested))
+	for server_id, server_summaries in servers.items():
+		summarize_rounds(server_id, server_summaries)
+	db.session.commit()
+
+	return {'message': f'Refresh of {len(stale_summaries)} stale metrics summaries successful'}
+
+
+
 #### Async tasks ####
 
 
@@ -134,15 +231,20 @@ def database_init():
 	# Initialize the database if it does not exist
 	messages = []
 
-	if not db.engine.table_names():
+	if set(db.metadata.tables) - set(db.engine.table_names()): # create the missing tables
 		db.create_all()
 		db.session.commit()
 		messages.append('Database initialized')
 
+	# Tables created by older versions of the service are upgraded in place
+	messages.extend(upgrade_schema())
+	db.session.commit()
+
 	if not ServerData.query.all():
 		weights      = fed_model.state_dict()
 		com_round_id = uuid.uuid1()
-		server = ServerData(server_id=SERVER_ID, state='waiting', weights=jspk.encode(weights), com_round_id=com_round_id, last_modified = datetime.utcnow())
+		model_version = create_version(SERVER_ID, com_round_id, jspk.encode(weights))
+		server = ServerData(server_id=SERVER_ID, state='waiting', model_version=model_version.version, com_round_id=com_round_id, last_modified = datetime.utcnow())
 		db.session.add(server)
 		db.session.commit()
 		messages.append('Database loaded')
@@ -157,22 +259,48 @@ def database_init():
 @celery.task(name='tasks.reset_server_weights')
 def reset_server_weights(server_id):
 	# Reset the server weights to an untrained state and set a new comunication round
+	server_id       = int(server_id)
 	com_round_id    = uuid.uuid1()
-	initial_weights = model.init_weights(init_seed=seed).state_dict()
-	update_dict     = {'state':'waiting', 'weights':jspk.encode(initial_weights), 'com_round_id':com_round_id, 'last_modified':datetime.utcnow()}
-	server          = ServerData.query.filter_by(server_id=server_id).update(update_dict)
+	server          = ServerData.query.filter_by(server_id=server_id).with_for_update().first()
+	if not server: # if server not found (result == None) return error
+		return {'message': f'Could not find server with id {server_id}'}
+	# The initial weights are stored as a new version, the history of the previous run is kept
+	model_version   = create_version(server_id, com_round_id, initial_weights(seed))
+	update_dict     = {'state':'waiting', 'model_version':model_version.version, 'com_round_id':com_round_id, 'last_modified':datetime.utcnow()}
+	ServerData.query.filter_by(server_id=server_id).update(update_dict)
 	db.session.commit()
 	
 	return {'message': 'Reset of server state successful.', 'server_id': server_id}
 
 
 
+@celery.task(name='tasks.reset_clients_weights')
+def reset_clients_weights(client_ids):
+	# Reset the clients weights to an untrained state with one bulk update
+	client_ids  = [int(client_id) for client_id in client_ids]
+	update_dict = {'state':'iddle', 'weights':initial_weights(seed), 'com_round_id':'', 'last_modified':datetime.utcnow()}
+	n_clients   = ClientsData.query.filter(ClientsData.client_id.in_(client_ids)).update(update_dict, synchronize_session=False)
+	db.session.commit()
+	
+	return {'message': f'Reset of {n_clients} clients state successful.', 'client_ids':client_ids}
+
+
+
 @celery.task(name='tasks.reset_client_weights')
 def reset_client_weights(client_id):
 	# Reset the client weights to an untrained state
-	initial_weights = model.init_weights(init_seed=seed).state_dict()
-	update_dict     = {'state':'iddle', 'weights':jspk.encode(initial_weights), 'com_round_id':'', 'last_modified':datetime.utcnow()}
-	client          = ClientsData.query.filter_by(client_id=client_id).update(update_dict)
-	db.session.commit()
+	reset_clients_weights([client_id])
 	
-	return {'message': 'Reset of client state successful.', 'client_id':client_id}
\ No newline at end of file
+	return {'message': 'Reset of client state successful.', 'client_id':client_id}
+
+
+
+@celery.task(name='tasks.reset_run')
+def reset_run(server_id, client_ids):
+	# Reset the server and the kept clients of a run, the run tables are truncated by the api
+	messages = []
+	messages.append(reset_server_weights(server_id)['message'])
+	if client_ids:
+		messages.append(reset_clients_weights(client_ids)['message'])
+
+	return {'messages': messages, 'server_id': server_id, 'client_ids': client_ids}
\ No newline at end of file
@@ -1,11 +1,14 @@
 import os
 import sys
 import requests
+import json
+import base64
 from sklearn.model_selection import train_test_split
 import jsonpickle as jpk
 import time
 import numpy as np
 import pandas as pd
+import torch
 # Federated imports
 import forcast_federated_learning as ffl
 
@@ -20,9 +23,49 @@ batch_size         = 1
 noise_multiplier   = 0.3
 max_grad_norm      = 0.5
 diff_privacy       = False
+delta_format       = 'quantized' # server model downloads as deltas: quantized or sparse
+max_delta_chain    = 5           # consecutive deltas before a full download
+
+# Requests helpers
+def poll_interval(resp, default=0.5):
+	# Next poll hint sent by the server
+	return float(resp.headers.get('X-Poll-Interval', default))
+
+def request_with_backoff(method, url, data, max_retries=20):
+	# Retry the weight transfers rejected by the server admission control after the suggested backoff
+	resp = requests.request(method, url, data=data)
+	for _ in range(max_retries):
+		if resp.status_code != 429:
+			return resp
+		time.sleep(float(resp.json().get('retry_after', resp.headers.get('Retry-After', 1))))
+		resp = requests.request(method, url, data=data)
+	resp.raise_for_status() # still rejected after max_retries
+	return resp
+
+def send_metrics(records):
+	# Send a batch of per round metrics to the server
+	data = {'server_id': SERVER_ID, 'client_id': CLIENT_ID, 'metrics': json.dumps(records)}
+	return requests.post(BASE + 'api/v1.0/metrics/', data=data)
+
+def apply_model_delta(state_dict, model_delta):
+	# Rebuild the server model from the last synced state_dict and a delta download
+	model_delta = json.loads(model_delta)
+	state_dict  = dict(state_dict)
+	for name, encoded in model_delta['tensors'].items():
+		base   = state_dict[name]
+		values = base.double().reshape(-1).clone()
+		if model_delta['format'] == 'quantized':
+			values += torch.from_numpy(np.frombuffer(base64.b64decode(encoded['values']), dtype=np.int8).astype(np.float64) * encoded['scale'])
+		else: # sparse: exact new values of the changed coordinates
+			indices = np.frombuffer(base64.b64decode(encoded['indices']), dtype=np.int32).astype(np.int64)
+			values[torch.from_numpy(indices)] = torch.from_numpy(np.frombuffer(base64.b64decode(encoded['values']), dtype=np.float32).astype(np.float64))
+		values = values.reshape(encoded['shape'])
+		state_dict[name] = (values if base.is_floating_point() else values.round()).to(base.dtype)
+	return state_dict
 
 # Metrics
-df_metrics = pd.DataFrame(dict(zip(['round', 'accuracy', 'loss', 'epsilon', 'delta'], [int,[],[],[],[]])))
+metrics       = [] # per round records, sent to the server in batches
+metrics_batch = 5
 
 # Load local train data
 X, y, df_data, target_names = ffl.datasets.load_scikit_iris()
@@ -78,13 +121,19 @@ print('Validated model:', inspector.validate(local_model.model))
 
 # Train step iterations
 round_count = 0
+next_poll   = 0.5
+# Last synced server model, base of the delta downloads
+server_state_dict = None
+version_key       = None
+delta_chain       = 0
 while round_count < com_rounds:
-	time.sleep(0.5)
+	time.sleep(next_poll)
 	#### Communication round ####
 
 	# Ckeck for server state
 	resp = requests.get(BASE + 'api/v1.0/server/', data={'server_id': SERVER_ID, 'return_keys': ['state', 'com_round_id']})
 	server_state, server_com_id  = map(resp.json().get, ['state', 'com_round_id'])
+	next_poll = poll_interval(resp)
 	if server_state != 'waiting':
 		continue
 
@@ -92,6 +141,7 @@ while round_count < com_rounds:
 	resp = requests.get(BASE + 'api/v1.0/clients/', data={'client_id': CLIENT_ID, 'return_keys': ['state', 'com_round_id']})
 	if resp.status_code == 404: # Not found
 		sys.exit()
+	next_poll = poll_interval(resp)
 	client_state, client_com_id  = map(resp.json().get, ['state', 'com_round_id'])
 
 	# Check if correct comunication round
@@ -103,11 +153,19 @@ while round_count < com_rounds:
 	if (client_state == 'iddle') and (server_com_id != client_com_id):
 		#### Train locally ####
 
-		# Get updated server model
-		resp = requests.get(BASE + 'api/v1.0/server/', data={'server_id': SERVER_ID, 'return_keys': ['weights']})
-		weights    = resp.json()['weights']
-		state_dict = jpk.decode(weights)
-		local_model.load_state_dict(state_dict)
+		# Get updated server model, as a delta of the last synced model when possible
+		data = {'server_id': SERVER_ID, 'return_keys': ['weights']}
+		if server_state_dict is not None and delta_chain < max_delta_chain:
+			data.update({'base_version_key': version_key, 'delta_format': delta_format})
+		resp = request_with_backoff('GET', BASE + 'api/v1.0/server/', data=data)
+		if resp.json().get('delta'):
+			server_state_dict = apply_model_delta(server_state_dict, resp.json()['delta'])
+			delta_chain      += 1
+		else: # full download
+			server_state_dict = jpk.decode(resp.json()['weights'])
+			delta_chain       = 0
+		version_key = resp.json()['version_key']
+		local_model.load_state_dict(server_state_dict)
 
 		acc, _   = local_model.test(test_loader)
 		loss     = local_model.step(train_loader)
@@ -123,22 +181,26 @@ while round_count < com_rounds:
 				  'state'       : 'updated',
 				  'com_round_id': server_com_id,
 				  'data_len'    : data_len}
-		resp   = requests.put(BASE + 'api/v1.0/clients/', data=data)
+		resp   = request_with_backoff('PUT', BASE + 'api/v1.0/clients/', data=data)
+		next_poll = poll_interval(resp)
 		round_count += 1
 		# Save metrics
 		if local_model.privacy_engine: # privacy spent 
-			df_aux       = pd.DataFrame({'round': [round_count], 'accuracy': [acc], 'loss': [loss], 'epsilon': [epsilon], 'delta':[delta] })
+			metrics.append({'round': round_count, 'accuracy': float(acc), 'loss': float(loss), 'epsilon': float(epsilon), 'delta': float(delta)})
 		else:
-			df_aux       = pd.DataFrame({'round': [round_count], 'accuracy': [acc], 'loss': [loss]})
-		df_metrics   = pd.concat([df_metrics, df_aux], axis=0)
+			metrics.append({'round': round_count, 'accuracy': float(acc), 'loss': float(loss)})
+		if round_count % metrics_batch == 0:
+			send_metrics(metrics[-metrics_batch:])
 
 print(f'Finished {com_rounds} iterations')
+# Send the metrics of the last incomplete batch
+if round_count % metrics_batch != 0:
+	send_metrics(metrics[-(round_count % metrics_batch):])
+df_metrics = pd.DataFrame(metrics)
 
 time.sleep(6)
-# If finished comunication rounds. Restart clients database
-resp = requests.post(BASE + 'api/v1.0/clear_table/', data={'table_name': 'clients_data', 'column': 'client_id'})
+# If finished comunication rounds. Restart clients database and server weights
+resp = requests.post(BASE + 'api/v1.0/reset_run/', data={'server_id': SERVER_ID, 'truncate': ['clients_data']})
 print(resp.json())
-# Restart server weights
-resp = requests.post(BASE + 'api/v1.0/reset/', data={'table_name': 'server_data', 'row_id': SERVER_ID})
 # # Save metrics onto csv file
 # df_metrics.to_csv(f'./client_{CLIENT_ID}.csv', index=False)
\ No newline at end of file
@@ -0,0 +1,27 @@
+# Imports
+import os
+import sys
+import pytest
+from flask import Flask
+
+# Repository root, to import the shared utils package like the services do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+
+#### Fixtures ####
+
+
+
+@pytest.fixture
+def database():
+	# In memory database with the service tables, bound to a fresh app context
+	from utils.models import db
+	app = Flask('test')
+	app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_TRACK_MODIFICATIONS=False)
+	db.init_app(app)
+	with app.app_context():
+		db.create_all()
+		yield db
+		db.session.remove()
+		db.drop_all()
@@ -0,0 +1,98 @@
+# Imports
+from collections import OrderedDict
+import pytest
+import torch
+from utils.aggregation import aggregate, aggregation_rules, stack_state_dicts, unstack_state_dict
+
+
+
+#### Helpers ####
+
+
+
+def state_dict(seed, num_batches_tracked=0):
+	# Small model layout with a float layer and an integer buffer, like a batch norm
+	generator = torch.Generator().manual_seed(seed)
+	return OrderedDict([
+		('layer.weight'       , torch.randn(3, 4, generator=generator)),
+		('layer.bias'         , torch.randn(3, generator=generator)),
+		('num_batches_tracked', torch.tensor(num_batches_tracked)),
+	])
+
+def fed_avg(client_weights, client_lens):
+	# Same formula as forcast_federated_learning FederatedModel.server_agregate with fed_avg
+	total = sum(client_lens)
+	n     = len(client_weights)
+	return {k: torch.stack([client_weights[i][k].float()*(n*client_lens[i]/total) for i in range(n)], 0).mean(0) for k in client_weights[0]}
+
+
+
+#### Tests ####
+
+
+
+def test_stack_and_unstack_round_trip():
+	clients         = [state_dict(seed, num_batches_tracked=seed) for seed in range(3)]
+	stacked, layout = stack_state_dicts(clients)
+	assert stacked.shape == (3, 3 * 4 + 3 + 1)
+	for row, client in zip(stacked, clients):
+		for name, tensor in unstack_state_dict(row, layout).items():
+			assert tensor.dtype == client[name].dtype
+			assert torch.equal(tensor, client[name])
+
+def test_mean_matches_fed_avg():
+	clients     = [state_dict(seed) for seed in range(5)]
+	client_lens = [10, 20, 5, 40, 25]
+	expected    = fed_avg(clients, client_lens)
+	result      = aggregate(clients, client_lens, rule='mean')
+	for name in ['layer.weight', 'layer.bias']:
+		assert torch.allclose(result[name], expected[name], atol=1e-6)
+
+def test_integer_buffers_are_rounded_and_cast_back():
+	clients = [state_dict(0, num_batches_tracked=3), state_dict(1, num_batches_tracked=6)]
+	result  = aggregate(clients, [1, 1], rule='mean')
+	assert result['num_batches_tracked'].dtype == torch.int64
+	assert result['num_batches_tracked'].item() == 4 # 4.5 rounded half to even
+
+@pytest.mark.parametrize('rule', sorted(aggregation_rules))
+@pytest.mark.parametrize('n_clients', [1, 2])
+def test_rules_with_few_clients(rule, n_clients):
+	clients = [state_dict(seed) for seed in range(n_clients)]
+	result  = aggregate(clients, [1] * n_clients, rule=rule, reference=state_dict(0), clip_norm=1e6)
+	if n_clients == 1: # every rule returns the only client
+		for name, tensor in clients[0].items():
+			assert torch.allclose(result[name].double(), tensor.double())
+	else:
+		assert all(torch.isfinite(tensor.double()).all() for tensor in result.values())
+
+def test_median_and_trimmed_mean_ignore_an_outlier():
+	clients = [state_dict(0) for _ in range(4)] + [OrderedDict((name, tensor * 1e6) for name, tensor in state_dict(0).items())]
+	for rule in ['median', 'trimmed_mean']:
+		result = aggregate(clients, [1] * 5, rule=rule, trim_ratio=0.2)
+		assert torch.allclose(result['layer.weight'], clients[0]['layer.weight'])
+
+def test_krum_selects_the_clustered_clients():
+	honest   = [OrderedDict((name, tensor + 0.01 * seed) if tensor.is_floating_point() else (name, tensor) for name, tensor in state_dict(0).items()) for seed in range(4)]
+	attacker = OrderedDict((name, tensor + 100) if tensor.is_floating_point() else (name, tensor) for name, tensor in state_dict(0).items())
+	result   = aggregate(honest + [attacker], [1] * 5, rule='krum', krum_f=1, krum_m=3)
+	assert (result['layer.weight'] - state_dict(0)['layer.weight']).abs().max() < 0.05
+
+def test_clipped_mean_clips_updates_relative_to_reference():
+	reference = state_dict(0)
+	# One client moves every coordinate by +1 from the reference, the update norm is sqrt(16)
+	moved     = OrderedDict((name, tensor + 1) if tensor.is_floating_point() else (name, tensor) for name, tensor in reference.items())
+	result    = aggregate([moved], [1], rule='clipped_mean', reference=reference, clip_norm=2.0)
+	update, _ = stack_state_dicts([result])
+	origin, _ = stack_state_dicts([reference])
+	assert torch.isclose((update - origin).norm(), torch.tensor(2.0, dtype=torch.float64), atol=1e-5)
+	# Updates under the clip norm are kept as they are
+	result    = aggregate([moved], [1], rule='clipped_mean', reference=reference, clip_norm=10.0)
+	assert torch.allclose(result['layer.weight'], moved['layer.weight'])
+
+def test_clipped_mean_without_reference_raises():
+	with pytest.raises(ValueError):
+		aggregate([state_dict(0)], [1], rule='clipped_mean')
+
+def test_unknown_rule_raises():
+	with pytest.raises(ValueError):
+		aggregate([state_dict(0)], [1], rule='fed_sgd')
@@ -0,0 +1,88 @@
+# Imports
+import uuid
+from datetime import datetime
+from utils.models import ClientsData, ServerData, ModelVersion, create_version, prune_versions, rollback_version, close_round
+
+SERVER_ID              = 1
+k_ready_clients_needed = 5
+keep_last_versions     = 5
+keep_every_version     = 10
+
+
+
+#### Helpers ####
+
+
+
+def upload(db, client_ids, com_round_id):
+	# Clients sending their trained weights for a comunication round
+	for client_id in client_ids:
+		client = ClientsData.query.get(client_id)
+		client.state, client.com_round_id, client.last_modified = 'updated', str(com_round_id), datetime.utcnow()
+	db.session.commit()
+
+def ready_clients(server_data):
+	# Same readiness filter as tasks.check_clients_update
+	return ClientsData.query.filter_by(state='updated').filter_by(com_round_id=server_data.com_round_id).all()
+
+def close(db, server_data):
+	# Round close of the ready clients, committed like tasks.check_clients_update
+	client_ids    = [client.client_id for client in ready_clients(server_data)]
+	model_version = close_round(server_data, client_ids, 'weights', uuid.uuid1(), keep_last_versions, keep_every_version)
+	db.session.commit()
+	return model_version
+
+
+
+#### Tests ####
+
+
+
+def test_versions_are_monotonic_and_pruned(database):
+	for com_round in range(12):
+		create_version(SERVER_ID, uuid.uuid1(), f'weights {com_round}')
+	database.session.commit()
+	prune_versions(SERVER_ID, keep_last=3, keep_every=5, pinned=2)
+	database.session.commit()
+	versions = [model_version.version for model_version in ModelVersion.query.order_by(ModelVersion.version)]
+	assert versions == [2, 5, 10, 11, 12]
+
+def test_rollback_mid_round_lets_the_next_round_close(database):
+	com_round_id  = uuid.uuid1()
+	model_version = create_version(SERVER_ID, com_round_id, 'initial weights')
+	server_data   = ServerData(server_id=SERVER_ID, state='waiting', model_version=model_version.version, com_round_id=str(com_round_id), last_modified=datetime.utcnow())
+	database.session.add(server_data)
+	database.session.add_all([ClientsData(client_id=client_id, state='iddle', weights='', data_len=1, com_round_id='', last_modified=datetime.utcnow()) for client_id in range(1, 7)])
+	database.session.commit()
+	close(database, server_data) # version 2, no participants yet
+
+	# Rollback to the initial version after some clients uploaded in the current round
+	upload(database, [1, 2, 3], server_data.com_round_id)
+	n_clients = rollback_version(server_data, 1, uuid.uuid1())
+	database.session.commit()
+	assert n_clients == 3
+	assert ClientsData.query.filter_by(state='updated').count() == 0
+	assert server_data.model_version == 1
+
+	# Every client trains again in the new round and the round closes
+	upload(database, range(1, 7), server_data.com_round_id)
+	assert len(ready_clients(server_data)) >= k_ready_clients_needed
+	model_version = close(database, server_data)
+	assert model_version.version == 3
+	assert ClientsData.query.filter_by(state='iddle').count() == 6
+	assert server_data.model_version == 3 and server_data.state == 'waiting'
+
+def test_close_round_skips_clients_of_another_round(database):
+	com_round_id  = uuid.uuid1()
+	model_version = create_version(SERVER_ID, com_round_id, 'initial weights')
+	server_data   = ServerData(server_id=SERVER_ID, state='waiting', model_version=model_version.version, com_round_id=str(com_round_id), last_modified=datetime.utcnow())
+	database.session.add(server_data)
+	database.session.add_all([ClientsData(client_id=client_id, state='iddle', weights='', data_len=1, com_round_id='', last_modified=datetime.utcnow()) for client_id in range(1, 4)])
+	database.session.commit()
+	upload(database, [1, 2], server_data.com_round_id)
+	upload(database, [3], uuid.uuid1()) # stale upload of an older round
+	model_version = close_round(server_data, [1, 2, 3], 'weights', uuid.uuid1(), keep_last_versions, keep_every_version)
+	database.session.commit()
+	assert model_version.version == 2
+	assert ClientsData.query.get(3).state == 'updated'
+	assert ClientsData.query.filter_by(state='iddle').count() == 2
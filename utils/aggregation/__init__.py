@@ -0,0 +1,2 @@
+#### Import sub-modules of the library ####
+from .aggregation import aggregate, aggregation_rules, stack_state_dicts, unstack_state_dict
\ No newline at end of file
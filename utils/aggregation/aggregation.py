@@ -0,0 +1,94 @@
+# Imports
+from collections import OrderedDict
+import torch
+
+
+
+#### Parameter stacking ####
+
+
+
+def stack_state_dicts(state_dicts):
+	# Flatten every participant state_dict into one row of a contiguous (clients x params) float64 tensor
+	tensors = map(torch.as_tensor, state_dicts[0].values())
+	layout  = [(name, tensor.shape, tensor.dtype) for name, tensor in zip(state_dicts[0].keys(), tensors)]
+	rows    = [torch.cat([torch.as_tensor(state_dict[name]).reshape(-1).to(torch.float64) for name, _, _ in layout]) for state_dict in state_dicts]
+	return torch.stack(rows), layout
+
+def unstack_state_dict(vector, layout):
+	# Split a flat parameter vector back into a state_dict with the original names, shapes and dtypes
+	state_dict = OrderedDict()
+	offset     = 0
+	for name, shape, dtype in layout:
+		size             = int(torch.Size(shape).numel())
+		values           = vector[offset:offset + size].reshape(shape)
+		state_dict[name] = values.round().to(dtype) if not dtype.is_floating_point else values.to(dtype)
+		offset          += size
+	return state_dict
+
+
+
+#### Aggregation rules ####
+
+
+
+def weighted_mean(stacked, weights, **kwargs):
+	# Average of the clients weighted by their local data length
+	weights = weights / weights.sum()
+	return weights @ stacked
+
+def coordinate_median(stacked, weights, **kwargs):
+	# Coordinate-wise median of the clients, ignores the data length
+	return stacked.median(dim=0).values
+
+def trimmed_mean(stacked, weights, trim_ratio=0.1, **kwargs):
+	# Coordinate-wise mean after dropping the trim_ratio highest and lowest values of every coordinate
+	n_clients = stacked.shape[0]
+	k_trim    = min(int(trim_ratio * n_clients), (n_clients - 1) // 2)
+	sorted_stacked = stacked.sort(dim=0).values
+	return sorted_stacked[k_trim:n_clients - k_trim].mean(dim=0)
+
+def clipped_mean(stacked, weights, clip_norm=1.0, reference=None, **kwargs):
+	# Weighted mean of the client updates with their L2 norm clipped to clip_norm, updates are relative to the reference model
+	if reference is None:
+		raise ValueError('clipped_mean needs the reference model the client updates are relative to')
+	updates   = stacked - reference
+	norms     = updates.norm(dim=1, keepdim=True)
+	updates   = updates * torch.clamp(clip_norm / norms.clamp(min=1e-12), max=1.0)
+	return reference + weighted_mean(updates, weights)
+
+def krum(stacked, weights, krum_f=1, krum_m=1, **kwargs):
+	# (Multi-)Krum: score every client with the distance to its n - f - 2 closest neighbours and average the krum_m best ones
+	n_clients   = stacked.shape[0]
+	k_neighbors = max(n_clients - krum_f - 2, 1)
+	distances   = torch.cdist(stacked, stacked).pow(2)
+	distances.fill_diagonal_(float('inf'))
+	scores      = distances.topk(min(k_neighbors, n_clients - 1), dim=1, largest=False).values.sum(dim=1) if n_clients > 1 else torch.zeros(1, dtype=stacked.dtype)
+	selected    = scores.topk(min(krum_m, n_clients), largest=False).indices
+	return weighted_mean(stacked[selected], weights[selected])
+
+aggregation_rules = {
+	'mean'        : weighted_mean,
+	'median'      : coordinate_median,
+	'trimmed_mean': trimmed_mean,
+	'clipped_mean': clipped_mean,
+	'krum'        : krum,
+}
+
+
+
+#### Aggregation engine ####
+
+
+
+def aggregate(state_dicts, data_lens, rule='mean', reference=None, **params):
+	# Aggregate the clients state_dicts with the selected rule over the stacked parameters
+	if rule not in aggregation_rules:
+		raise ValueError(f'Aggregation rule {rule} not supported, use one of {list(aggregation_rules)}')
+	stacked, layout = stack_state_dicts(state_dicts)
+	weights         = torch.as_tensor(data_lens, dtype=torch.float64)
+	if reference is not None:
+		reference, _ = stack_state_dicts([reference])
+		reference    = reference[0]
+	vector = aggregation_rules[rule](stacked, weights, reference=reference, **params)
+	return unstack_state_dict(vector, layout)
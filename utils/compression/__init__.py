@@ -0,0 +1,2 @@
+#### Import sub-modules of the library ####
+from .compression import encode_delta, delta_formats
\ No newline at end of file
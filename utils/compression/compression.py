@@ -0,0 +1,38 @@
+# Imports
+import base64
+import json
+import numpy as np
+
+
+
+#### Model deltas ####
+
+
+
+delta_formats = ['quantized', 'sparse']
+
+def to_numpy(tensor):
+	# Torch tensors and array-likes as numpy arrays
+	return tensor.detach().cpu().numpy() if hasattr(tensor, 'detach') else np.asarray(tensor)
+
+def to_base64(array):
+	return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')
+
+def encode_delta(state_dict, base_state_dict, delta_format='quantized'):
+	# Compact json difference between two state_dicts with the same layout
+	#   quantized: per tensor int8 difference with its scale, lossy (error <= scale / 2 per coordinate)
+	#   sparse   : changed coordinates with their exact new float32 values, lossless for float32 models
+	if delta_format not in delta_formats:
+		raise ValueError(f'Delta format {delta_format} not supported, use one of {delta_formats}')
+	tensors = {}
+	for name, tensor in state_dict.items():
+		values = to_numpy(tensor)
+		diff   = values.astype(np.float64) - to_numpy(base_state_dict[name]).astype(np.float64)
+		if delta_format == 'quantized':
+			scale     = float(np.abs(diff).max()) / 127 if diff.size else 0.0
+			quantized = np.round(diff / scale) if scale > 0 else np.zeros(diff.shape)
+			tensors[name] = {'shape': list(values.shape), 'scale': scale, 'values': to_base64(quantized.astype(np.int8))}
+		else:
+			indices = np.flatnonzero(diff)
+			tensors[name] = {'shape': list(values.shape), 'indices': to_base64(indices.astype(np.int32)), 'values': to_base64(values.reshape(-1)[indices].astype(np.float32))}
+	return json.dumps({'format': delta_format, 'tensors': tensors})
@@ -1,2 +1,4 @@
 #### Import sub-modules of the library ####
-from .models import ClientsData, ServerData, db
+from .models import ClientsData, ServerData, ModelVersion, MetricsData, MetricsSummary, db
+from .versions import latest_version, create_version, prune_versions, rollback_version, close_round
+from .migrations import upgrade_schema
\ No newline at end of file
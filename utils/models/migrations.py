@@ -0,0 +1,40 @@
+# Imports
+from sqlalchemy import inspect, text
+# Database imports
+from .models import ServerData, db
+from .versions import create_version
+
+
+
+#### Schema upgrades ####
+
+
+
+# Idempotent statements bringing the tables created by older versions of the service up to date, db.create_all only creates missing tables
+upgrade_statements = [
+	'ALTER TABLE server_data ADD COLUMN IF NOT EXISTS model_version INTEGER',
+	'ALTER TABLE model_versions ADD COLUMN IF NOT EXISTS version_key VARCHAR',
+	"UPDATE model_versions SET version_key = md5(random()::text || server_id || '_' || version) WHERE version_key IS NULL",
+	'ALTER TABLE model_versions ALTER COLUMN version_key SET NOT NULL',
+	'ALTER TABLE metrics_summary ADD COLUMN IF NOT EXISTS ingested INTEGER NOT NULL DEFAULT 0',
+	'CREATE INDEX IF NOT EXISTS ix_clients_data_round_state ON clients_data (com_round_id, state)',
+	'CREATE INDEX IF NOT EXISTS ix_clients_data_state ON clients_data (state)',
+]
+
+def upgrade_schema():
+	# Upgrade the existing tables in place, the caller commits. Returns the applied upgrade messages
+	messages = []
+	for statement in upgrade_statements:
+		db.session.execute(text(statement))
+
+	# Server weights stored in server_data before the model versions: moved to a first version pointed by the server
+	server_columns = {column['name'] for column in inspect(db.engine).get_columns('server_data')}
+	if 'weights' in server_columns:
+		rows = db.session.execute(text('SELECT server_id, com_round_id, weights FROM server_data WHERE model_version IS NULL')).fetchall()
+		for server_id, com_round_id, weights in rows:
+			model_version = create_version(server_id, com_round_id, weights)
+			ServerData.query.filter_by(server_id=server_id).update({'model_version': model_version.version}, synchronize_session=False)
+		db.session.execute(text('ALTER TABLE server_data DROP COLUMN weights'))
+		messages.append(f'Moved the weights of {len(rows)} servers to model versions')
+
+	return messages
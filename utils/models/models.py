@@ -12,6 +12,8 @@ db = SQLAlchemy()
 # Database class
 class ClientsData(db.Model):
 	__tablename__ = 'clients_data'
+	# Round status queries filter by comunication round and state, listings by state
+	__table_args__ = (db.Index('ix_clients_data_round_state', 'com_round_id', 'state'), db.Index('ix_clients_data_state', 'state'))
 
 	client_id     = db.Column(db.Integer, primary_key=True) # unique id identifier per client
 	state         = db.Column(db.String,  nullable=False)
@@ -29,9 +31,62 @@ class ServerData(db.Model):
 
 	server_id     = db.Column(db.Integer, primary_key=True) # unique id identifier per server
 	state         = db.Column(db.String,  nullable=False)
-	weights       = db.Column(db.String,  nullable=False)
+	model_version = db.Column(db.Integer) # pointer to the served version of the model_versions table
 	com_round_id  = db.Column(db.String,  nullable=False)
 	last_modified = db.Column(db.String,  nullable=False)
 
 	def __repr__(self):
-		return f'Server {self.server_id} in state {self.state}'
\ No newline at end of file
+		return f'Server {self.server_id} in state {self.state}'
+
+# Database class
+class ModelVersion(db.Model):
+	__tablename__ = 'model_versions'
+
+	server_id     = db.Column(db.Integer, primary_key=True)
+	version       = db.Column(db.Integer, primary_key=True) # monotonic version number per server
+	com_round_id  = db.Column(db.String,  nullable=False, index=True) # comunication round served with this version
+	version_key   = db.Column(db.String,  nullable=False) # unique per stored version, version numbers restart when a server is recreated
+	weights       = db.Column(db.String,  nullable=False) # immutable, never updated after insertion
+	last_modified = db.Column(db.String,  nullable=False)
+
+	def __repr__(self):
+		return f'Model version {self.version} of server {self.server_id}'
+
+# Database class
+class MetricsData(db.Model):
+	__tablename__ = 'metrics_data'
+	# Append only, one row per client, round and metric. Rows are read by job (server) and round partition
+	__table_args__ = (db.Index('ix_metrics_data_partition', 'server_id', 'com_round', 'metric'),)
+
+	metric_id     = db.Column(db.Integer, primary_key=True) # unique id identifier per metric value
+	server_id     = db.Column(db.Integer, nullable=False)
+	com_round     = db.Column(db.Integer, nullable=False)
+	client_id     = db.Column(db.Integer, nullable=False)
+	metric        = db.Column(db.String,  nullable=False)
+	value         = db.Column(db.Float,   nullable=False)
+	last_modified = db.Column(db.String,  nullable=False)
+
+	def __repr__(self):
+		return f'Metric {self.metric} of client {self.client_id} in round {self.com_round}'
+
+# Database class
+class MetricsSummary(db.Model):
+	__tablename__ = 'metrics_summary'
+
+	server_id     = db.Column(db.Integer, primary_key=True)
+	com_round     = db.Column(db.Integer, primary_key=True)
+	metric        = db.Column(db.String,  primary_key=True)
+	stale         = db.Column(db.Boolean, nullable=False, default=True) # new rows ingested since the last summary
+	ingested      = db.Column(db.Integer, nullable=False, default=0)    # ingestions counter, a summary only clears stale if it did not change
+	participants  = db.Column(db.Integer)
+	count         = db.Column(db.Integer)
+	mean          = db.Column(db.Float)
+	min           = db.Column(db.Float)
+	p10           = db.Column(db.Float)
+	p50           = db.Column(db.Float)
+	p90           = db.Column(db.Float)
+	max           = db.Column(db.Float)
+	last_modified = db.Column(db.String)
+
+	def __repr__(self):
+		return f'Summary of metric {self.metric} in round {self.com_round}'
@@ -0,0 +1,60 @@
+# Imports
+import uuid
+from datetime import datetime
+from sqlalchemy import func
+# Database imports
+from .models import ClientsData, ModelVersion, db
+
+
+
+#### Model versions ####
+
+
+
+# The callers must hold the lock of the server row so the version numbers stay monotonic
+
+def latest_version(server_id):
+	# Highest version number of the server, 0 if there are no versions
+	return db.session.query(func.max(ModelVersion.version)).filter_by(server_id=server_id).scalar() or 0
+
+def create_version(server_id, com_round_id, weights):
+	# Store a new immutable version of the server model, the caller commits and swaps the server pointer
+	model_version = ModelVersion(server_id=server_id, version=latest_version(server_id) + 1, com_round_id=str(com_round_id), version_key=uuid.uuid4().hex, weights=weights, last_modified=datetime.utcnow())
+	db.session.add(model_version)
+	return model_version
+
+def prune_versions(server_id, keep_last, keep_every, pinned=None):
+	# Retention policy: keep the last keep_last versions, every keep_every-th version and the pinned (served) one
+	query = ModelVersion.query.filter_by(server_id=server_id).filter(ModelVersion.version <= latest_version(server_id) - keep_last).filter(ModelVersion.version % keep_every != 0)
+	if pinned is not None:
+		query = query.filter(ModelVersion.version != pinned)
+	return query.delete(synchronize_session=False)
+
+
+def rollback_version(server_data, version, com_round_id):
+	# Pointer swap of the server to an old version and new comunication round to train from it.
+	# The clients that already uploaded in the dropped round go back to iddle, otherwise they never train again
+	dropped_round_id = server_data.com_round_id
+	last_modified    = datetime.utcnow()
+	server_data.model_version = version
+	server_data.state         = 'waiting'
+	server_data.com_round_id  = str(com_round_id)
+	server_data.last_modified = last_modified
+	update_dict = {'state':'iddle', 'last_modified':last_modified}
+	return ClientsData.query.filter_by(state='updated').filter_by(com_round_id=dropped_round_id).update(update_dict, synchronize_session=False)
+
+
+def close_round(server_data, client_ids, weights, com_round_id, keep_last, keep_every):
+	# Round close: new version with the aggregated weights, pointer swap, new comunication round and prune of the old versions.
+	# The participants go back to iddle with one bulk statement, only the ones still in the aggregated round
+	closed_round_id = server_data.com_round_id
+	last_modified   = datetime.utcnow()
+	model_version   = create_version(server_data.server_id, com_round_id, weights)
+	server_data.model_version = model_version.version
+	server_data.state         = 'waiting'
+	server_data.com_round_id  = str(com_round_id)
+	server_data.last_modified = last_modified
+	update_dict = {'state':'iddle', 'last_modified':last_modified}
+	ClientsData.query.filter(ClientsData.client_id.in_(client_ids)).filter_by(state='updated').filter_by(com_round_id=closed_round_id).update(update_dict, synchronize_session=False)
+	prune_versions(server_data.server_id, keep_last, keep_every, pinned=model_version.version)
+	return model_version
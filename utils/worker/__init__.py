@@ -1,2 +1,2 @@
 #### Import sub-modules of the library ####
-from .worker import app, api, celery, db
\ No newline at end of file
+from .worker import app, api, celery, db, redis_store
\ No newline at end of file
@@ -3,6 +3,7 @@ from flask import Flask
 from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
 from celery import Celery
+from redis import Redis
 # Database imports
 from utils.models import ClientsData, ServerData, db
 
@@ -49,7 +50,8 @@ def make_celery(app):
 
 
 
-celery  = make_celery(app)
-api     = Api(app)
+celery      = make_celery(app)
+api         = Api(app)
+redis_store = Redis.from_url(app.config['broker_url'])
 db.init_app(app)
 app.app_context().push()